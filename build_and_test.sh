@@ -89,6 +89,7 @@ run_test() {
         -v "$(pwd)/test/input:/app/input:ro" \
         -v "$(pwd)/test/output:/app/output" \
         --network none \
+        --shm-size=2g \
         ${IMAGE_NAME}:${TAG} || print_error "Container execution failed"
     end_time=$(date +%s)
     execution_time=$((end_time - start_time))
@@ -7,141 +7,387 @@ Description: This version fixes a critical NameError bug, improves error handlin
 """
 
 import os
+import re
 import sys
-import json
 import time
+import ctypes
 import logging
 from pathlib import Path
-from multiprocessing import cpu_count
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from typing import List, Dict, Tuple, Any
+from multiprocessing import cpu_count, resource_tracker, shared_memory
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 from collections import defaultdict
+from typing import List, Dict, Tuple, Any, NamedTuple, Optional
 import warnings
 
 # Suppress library warnings for a cleaner output
 warnings.filterwarnings("ignore")
 
+# The process pools already provide parallelism, so every native thread pool is pinned to one
+# thread to keep num_cores workers from oversubscribing the machine. OpenMP/MKL/OpenBLAS and
+# libtesseract read these only when they load, so they must be set before the imports below
+# (the Docker image sets the same values; these cover runs outside it).
+for _thread_var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "OMP_THREAD_LIMIT"):
+    os.environ.setdefault(_thread_var, "1")
+
 # PDF and image processing
 import fitz  # PyMuPDF
+import pypdfium2 as pdfium
+import pypdfium2.raw as pdfium_c
 import cv2
 import numpy as np
+from numba import njit
 
 # OCR libraries
-import pytesseract
+import torch
 import easyocr
+from PIL import Image
+from tesserocr import PyTessBaseAPI, PSM, OEM, RIL, iterate_level
+
+# Fast JSON serialization
+import orjson
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Render zoom for pages with embedded images (scans); all box coordinates are expressed at this zoom.
+# Pages without images are vector/text only and stay legible at a lower zoom, which cuts the
+# number of pixels every later stage has to touch.
+PAGE_ZOOM = 1.5
+TEXT_PAGE_ZOOM = 0.9
+
+# Pages whose text layer holds more characters than this are read directly instead of OCR'd
+NATIVE_TEXT_MIN_CHARS = 100
+
+# Native text carries exact point sizes (body and section headings are often only ~10% apart),
+# so native lines use their own, tighter size ratios against the median. Bold is an extra
+# signal: a bold line above the median size is an H2 even below NATIVE_H2_RATIO.
+NATIVE_H1_RATIO = 1.4
+NATIVE_H2_RATIO = 1.05
+# Native heading lines must contain a word; inline equations are set slightly above body size
+# and would otherwise pass the size ratios
+NATIVE_WORD_PATTERN = re.compile(r'[^\W\d_]{3}')
+
+# Upper bound on pages being rendered or held in shared memory at once; further renders wait for
+# OCR blocks to drain below it, within one PDF as well as across PDFs (~3.3 MB per Letter page at
+# PAGE_ZOOM, so ~420 MB in total against the documented --shm-size=2g)
+MAX_PAGES_IN_FLIGHT = 128
+
+# Grid resolution used to bucket boxes during ensemble NMS
+NMS_GRID_DIVISIONS = 20
+
+# EasyOCR's CRAFT detector works on inputs whose sides are multiples of this
+EASYOCR_SIZE_MULTIPLE = 32
+
+# Pages per EasyOCR detector pass, independent of the OCR block size. CRAFT's activations run to
+# hundreds of MB per page at PAGE_ZOOM, so this caps each worker's peak memory.
+EASYOCR_MAX_BATCH = 2
+
 # --- Global variables for worker processes ---
 # These will be initialized once per worker to avoid slow model reloading.
 EASYOCR_READER = None
+TESS_API = None
 
 def initialize_worker():
     """Initializes OCR engines once per worker process."""
-    global EASYOCR_READER
+    global EASYOCR_READER, TESS_API
     # This check ensures the model is loaded only if it hasn't been already
     if EASYOCR_READER is None:
+        # torch's inter-op pool and OpenCV's pool are not governed by the variables set at import time
+        torch.set_num_threads(1)
+        torch.set_num_interop_threads(1)
+        cv2.setNumThreads(0)
         logger.info(f"Initializing EasyOCR model for process ID: {os.getpid()}...")
-        EASYOCR_READER = easyocr.Reader(['en'], gpu=False, verbose=False)
+        # quantize=True applies dynamic int8 quantization to the CRAFT detector and CRNN recognizer on CPU
+        EASYOCR_READER = easyocr.Reader(['en'], gpu=False, verbose=False, quantize=True, cudnn_benchmark=True)
+    # Keep a libtesseract handle open for the worker's lifetime instead of spawning the CLI per page
+    if TESS_API is None:
+        TESS_API = PyTessBaseAPI(psm=PSM.SINGLE_BLOCK, oem=OEM.LSTM_ONLY)
 
 # --- Data Structures and Core Helpers ---
 
 class BoundingBox:
     """Optimized bounding box representation."""
-    __slots__ = ['x1', 'y1', 'x2', 'y2', 'text', 'confidence', 'font_size', 'area']
+    __slots__ = ['x1', 'y1', 'x2', 'y2', 'text', 'confidence', 'font_size', 'bold', 'area', 'n_chars', 'n_spaces', 'ends_dot']
 
-    def __init__(self, x1: float, y1: float, x2: float, y2: float, text: str, confidence: float, font_size: float):
+    def __init__(self, x1: float, y1: float, x2: float, y2: float, text: str, confidence: float, font_size: float,
+                 bold: Optional[bool] = None):
         self.x1, self.y1, self.x2, self.y2 = x1, y1, x2, y2
         self.text = text.strip()
         self.confidence = confidence
         self.font_size = font_size
+        # Only known for native text-layer boxes; None for OCR output
+        self.bold = bold
         self.area = (x2 - x1) * (y2 - y1)
+        # Cached text features used by the heading filter
+        self.n_chars = len(self.text)
+        self.n_spaces = self.text.count(' ')
+        self.ends_dot = self.text.endswith('.')
+
+class PageBuffer(NamedTuple):
+    """Handle to a rendered page image living in POSIX shared memory."""
+    shm_name: str
+    shape: Tuple[int, ...]
+    dtype: str
+    scale: float  # Multiplier mapping pixel coordinates back to PAGE_ZOOM space
+
+def release_page_buffer(page_buffer: PageBuffer):
+    """Frees the shared memory block backing a page once no worker needs it."""
+    try:
+        shm = shared_memory.SharedMemory(name=page_buffer.shm_name)
+        shm.close()
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+
+@njit(cache=True, fastmath=True)
+def _nms(x1, y1, x2, y2, area, conf, thr):
+    """Greedy confidence-ordered NMS over SoA box arrays; returns indices of the kept boxes."""
+    n = conf.size
+    # Bucket box centers into a coarse grid. Cells are never smaller than the largest box, so
+    # two overlapping boxes always land in the same or neighbouring cells.
+    min_x, min_y = x1.min(), y1.min()
+    cell_w = max(max((x2.max() - min_x) / NMS_GRID_DIVISIONS, (x2 - x1).max()), 1.0)
+    cell_h = max(max((y2.max() - min_y) / NMS_GRID_DIVISIONS, (y2 - y1).max()), 1.0)
+    gx = (((x1 + x2) * 0.5 - min_x) / cell_w).astype(np.int64)
+    gy = (((y1 + y2) * 0.5 - min_y) / cell_h).astype(np.int64)
+    cols, rows = gx.max() + 1, gy.max() + 1
+    cell = gy * cols + gx
+    by_cell = np.argsort(cell, kind='mergesort')
+    cell_start = np.searchsorted(cell[by_cell], np.arange(rows * cols + 1))
+
+    order = np.argsort(-conf, kind='mergesort')
+    done = np.zeros(n, dtype=np.bool_)  # Kept or suppressed
+    keep = np.empty(n, dtype=np.int64)
+    n_keep = 0
+    for i in order:
+        if done[i]:
+            continue
+        done[i] = True
+        keep[n_keep] = i
+        n_keep += 1
+        for cy in range(max(gy[i] - 1, 0), min(gy[i] + 2, rows)):
+            for cx in range(max(gx[i] - 1, 0), min(gx[i] + 2, cols)):
+                c = cy * cols + cx
+                for k in range(cell_start[c], cell_start[c + 1]):
+                    j = by_cell[k]
+                    if done[j]:
+                        continue
+                    iw = min(x2[i], x2[j]) - max(x1[i], x1[j])
+                    ih = min(y2[i], y2[j]) - max(y1[i], y1[j])
+                    if iw <= 0 or ih <= 0:
+                        continue
+                    inter = iw * ih
+                    if inter / (area[i] + area[j] - inter + 1e-9) > thr:
+                        done[j] = True
+    return keep[:n_keep]
 
-def calculate_iou_fast(box1: BoundingBox, box2: BoundingBox) -> float:
-    """Fast IoU calculation optimized for performance."""
-    if box1.x2 <= box2.x1 or box2.x2 <= box1.x1 or box1.y2 <= box2.y1 or box2.y2 <= box1.y1:
-        return 0.0
-    ix1, iy1 = max(box1.x1, box2.x1), max(box1.y1, box2.y1)
-    ix2, iy2 = min(box1.x2, box2.x2), min(box1.y2, box2.y2)
-    # --- BUG FIX: Changed 'y1' to 'iy1' ---
-    intersection = max(0, ix2 - ix1) * max(0, iy2 - iy1)
-    if intersection == 0:
-        return 0.0
-    union = box1.area + box2.area - intersection
-    return intersection / union if union > 0 else 0.0
+def warm_up_nms():
+    """Triggers JIT compilation of the NMS kernel with the argument types used at runtime.
+
+    Only the parent process runs NMS; the Docker build calls this once so the compiled kernel
+    is loaded from numba's on-disk cache instead of being compiled during the timed run.
+    """
+    dummy = np.zeros(1, dtype=np.float32)
+    _nms(dummy, dummy, dummy, dummy, dummy, dummy, 0.25)
 
 def get_cpu_cores() -> int:
     """Get optimal number of CPU cores for processing."""
     return min(cpu_count(), 8)
 
-def extract_pdf_pages_fast(pdf_path: Path) -> List[bytes]:
-    """Fast PDF page extraction as compressed image bytes."""
+def render_page(pdf_path: Path, page_idx: int, zoom: float) -> PageBuffer:
+    """Rasterizes one page with pdfium (in a render worker) directly into shared memory.
+
+    The pdfium bitmap is created over the shared memory block itself, so the rendered pixels
+    are never copied out of an intermediate buffer.
+    """
+    pdf = pdfium.PdfDocument(str(pdf_path))
+    try:
+        page = pdf[page_idx]
+        width_pt, height_pt = page.get_size()
+        width, height = round(width_pt * zoom), round(height_pt * zoom)
+        shm = shared_memory.SharedMemory(create=True, size=width * height * 3)
+        try:
+            buffer = (ctypes.c_ubyte * (width * height * 3)).from_buffer(shm.buf)
+            bitmap = pdfium_c.FPDFBitmap_CreateEx(width, height, pdfium_c.FPDFBitmap_BGR, buffer, width * 3)
+            try:
+                pdfium_c.FPDFBitmap_FillRect(bitmap, 0, 0, width, height, 0xFFFFFFFF)
+                # FPDF_REVERSE_BYTE_ORDER makes pdfium write RGB instead of BGR
+                pdfium_c.FPDF_RenderPageBitmap(bitmap, page.raw, 0, 0, width, height, 0,
+                                               pdfium_c.FPDF_ANNOT | pdfium_c.FPDF_REVERSE_BYTE_ORDER)
+            finally:
+                pdfium_c.FPDFBitmap_Destroy(bitmap)
+                # The ctypes view must be dropped before the mapping can be closed
+                del buffer
+        except Exception:
+            shm.close()
+            shm.unlink()
+            raise
+        # The parent owns the block from here on and unlinks it via release_page_buffer; without
+        # this the worker's resource tracker (Python < 3.13) would also claim it. Done only after
+        # a successful render so the unlink on the error path above still finds it registered.
+        resource_tracker.unregister(shm._name, "shared_memory")
+        shm.close()
+        return PageBuffer(shm.name, (height, width, 3), np.dtype(np.uint8).str, PAGE_ZOOM / zoom)
+    finally:
+        pdf.close()
+
+def extract_pdf_pages_fast(pdf_path: Path) -> List[Tuple[str, int, Any]]:
+    """Fast PDF page extraction.
+
+    Pages that already carry a text layer are returned as ("native", page_idx, blocks) and
+    skip OCR entirely; all other pages are returned as ("image", page_idx, zoom) with the zoom
+    they are to be rasterized at.
+    """
+    records = []
     try:
-        doc = fitz.open(pdf_path)
-        page_bytes = [page.get_pixmap(matrix=fitz.Matrix(1.5, 1.5)).tobytes("png") for page in doc]
-        doc.close()
-        return page_bytes
+        with fitz.open(pdf_path) as doc:
+            for page_idx, page in enumerate(doc):
+                blocks = page.get_text("dict", flags=fitz.TEXTFLAGS_TEXT)['blocks']
+                n_chars = sum(len(span['text']) for block in blocks for line in block.get('lines', [])
+                              for span in line.get('spans', []))
+                if n_chars > NATIVE_TEXT_MIN_CHARS:
+                    records.append(("native", page_idx, blocks))
+                else:
+                    records.append(("image", page_idx, PAGE_ZOOM if page.get_images() else TEXT_PAGE_ZOOM))
+        return records
     except Exception as e:
         logger.error(f"Failed to extract pages from {pdf_path}: {e}")
         return []
 
+def native_blocks_to_boxes(blocks: List[Dict[str, Any]]) -> List[BoundingBox]:
+    """Converts PyMuPDF text blocks into one box per visual line, in the same PAGE_ZOOM space as OCR output.
+
+    PyMuPDF can split a visual line into several lines (e.g. a section number and its title),
+    so lines of a block that share a baseline are merged before the box is built.
+    """
+    boxes = []
+    for block in blocks:
+        rows = defaultdict(list)
+        for line in block.get('lines', []):
+            spans = line['spans']
+            # Whitespace-only spans are kept: they are often the only separator between words
+            if spans and ''.join(span['text'] for span in spans).strip():
+                rows[round(spans[0]['origin'][1], 1)].append((line['bbox'], spans))
+        for row in rows.values():
+            row.sort(key=lambda item: item[0][0])
+            text = ' '.join(''.join(span['text'] for span in line_spans) for _, line_spans in row)
+            # Size and weight come from the spans that actually carry glyphs
+            spans = [span for _, line_spans in row for span in line_spans if span['text'].strip()]
+            x1, y1 = min(bbox[0] for bbox, _ in row), min(bbox[1] for bbox, _ in row)
+            x2, y2 = max(bbox[2] for bbox, _ in row), max(bbox[3] for bbox, _ in row)
+            boxes.append(BoundingBox(x1 * PAGE_ZOOM, y1 * PAGE_ZOOM, x2 * PAGE_ZOOM, y2 * PAGE_ZOOM,
+                                     ' '.join(text.split()), 1.0, max(span['size'] for span in spans) * PAGE_ZOOM,
+                                     all(span['flags'] & fitz.TEXT_FONT_BOLD for span in spans)))
+    return boxes
+
 # --- OCR Engine Functions (to be called by workers) ---
 
-def run_tesseract(image_bytes: bytes) -> List[BoundingBox]:
-    """Runs Tesseract OCR on image bytes."""
+def run_tesseract(image: np.ndarray, scale: float = 1.0) -> List[BoundingBox]:
+    """Runs Tesseract OCR on a raw page image using the pre-initialized worker API handle."""
+    global TESS_API
+    if not TESS_API:
+        return []
     try:
-        nparr = np.frombuffer(image_bytes, np.uint8)
-        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        config = '--psm 6 --oem 3'
-        data = pytesseract.image_to_data(image, output_type=pytesseract.Output.DICT, config=config)
+        TESS_API.SetImage(Image.fromarray(image))
+        TESS_API.Recognize()
+        iterator = TESS_API.GetIterator()
+        if iterator is None:
+            return []
         boxes = []
-        for i in range(len(data['text'])):
-            text, conf = data['text'][i].strip(), int(data['conf'][i])
-            if len(text) > 1 and conf > 30:
-                x, y, w, h = data['left'][i], data['top'][i], data['width'][i], data['height'][i]
-                boxes.append(BoundingBox(x, y, x + w, y + h, text, conf / 100.0, max(8.0, h * 0.8)))
+        for word in iterate_level(iterator, RIL.WORD):
+            text, conf = (word.GetUTF8Text(RIL.WORD) or '').strip(), word.Confidence(RIL.WORD)
+            bbox = word.BoundingBox(RIL.WORD)
+            if bbox and len(text) > 1 and conf > 30:
+                x1, y1, x2, y2 = (coord * scale for coord in bbox)
+                boxes.append(BoundingBox(x1, y1, x2, y2, text, conf / 100.0, max(8.0, (y2 - y1) * 0.8)))
         return boxes
     except Exception as e:
         logger.error(f"Tesseract failed with exception: {e}")
         return []
 
-def run_easyocr(image_bytes: bytes) -> List[BoundingBox]:
-    """Runs EasyOCR on image bytes using the pre-initialized worker model."""
+def run_easyocr_batch(images: List[np.ndarray], page_scales: List[float]) -> List[List[BoundingBox]]:
+    """Runs EasyOCR over a block of pages in batched passes of at most EASYOCR_MAX_BATCH pages."""
+    all_boxes = []
+    for batch_start in range(0, len(images), EASYOCR_MAX_BATCH):
+        all_boxes.extend(_run_easyocr_sub_batch(images[batch_start:batch_start + EASYOCR_MAX_BATCH],
+                                                page_scales[batch_start:batch_start + EASYOCR_MAX_BATCH]))
+    return all_boxes
+
+def _run_easyocr_sub_batch(images: List[np.ndarray], page_scales: List[float]) -> List[List[BoundingBox]]:
+    """Runs EasyOCR on a batch of pages with a single batched detector/recognizer pass."""
     global EASYOCR_READER
     if not EASYOCR_READER:
-        return []
+        return [[] for _ in images]
     try:
-        nparr = np.frombuffer(image_bytes, np.uint8)
-        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        results = EASYOCR_READER.readtext(image, detail=1, paragraph=False)
-        boxes = []
-        for coords, text, conf in results:
-            if conf > 0.4 and len(text.strip()) > 1:
-                x_coords, y_coords = [p[0] for p in coords], [p[1] for p in coords]
-                x1, y1, x2, y2 = min(x_coords), min(y_coords), max(x_coords), max(y_coords)
-                boxes.append(BoundingBox(x1, y1, x2, y2, text, conf, max(8.0, (y2 - y1) * 0.8)))
-        return boxes
+        # Pad every page into one (B, H, W, 3) array so the detector runs a single stacked batch.
+        # Padding (rather than resizing) keeps coordinates in each page's own pixel space; the
+        # fill is white to match the page background and avoid spurious edge detections.
+        sizes = [image.shape[:2] for image in images]
+        max_h = -(-max(h for h, _ in sizes) // EASYOCR_SIZE_MULTIPLE) * EASYOCR_SIZE_MULTIPLE
+        max_w = -(-max(w for _, w in sizes) // EASYOCR_SIZE_MULTIPLE) * EASYOCR_SIZE_MULTIPLE
+        padded = np.full((len(images), max_h, max_w, 3), 255, dtype=np.uint8)
+        for slot, image in zip(padded, images):
+            slot[:image.shape[0], :image.shape[1]] = image
+        batch_results = EASYOCR_READER.readtext_batched(padded, n_width=max_w, n_height=max_h,
+                                                        detail=1, paragraph=False)
+        all_boxes = []
+        for results, (h, w), page_scale in zip(batch_results, sizes, page_scales):
+            boxes = []
+            for coords, text, conf in results:
+                if conf > 0.4 and len(text.strip()) > 1:
+                    # Clip to the original page so nothing spills into the padding
+                    x_coords = [min(max(p[0], 0), w) * page_scale for p in coords]
+                    y_coords = [min(max(p[1], 0), h) * page_scale for p in coords]
+                    x1, y1, x2, y2 = min(x_coords), min(y_coords), max(x_coords), max(y_coords)
+                    boxes.append(BoundingBox(x1, y1, x2, y2, text, conf, max(8.0, (y2 - y1) * 0.8)))
+            all_boxes.append(boxes)
+        return all_boxes
     except Exception as e:
         logger.error(f"EasyOCR failed: {e}")
-        return []
+        return [[] for _ in images]
+
+def run_page_block(page_buffers: List[PageBuffer]) -> List[Dict[str, List[BoundingBox]]]:
+    """Runs both OCR engines over a contiguous block of shared-memory pages inside a single worker task."""
+    shms = [shared_memory.SharedMemory(name=page_buffer.shm_name) for page_buffer in page_buffers]
+    # Attaching registers the block with this worker's resource tracker on Python < 3.13, which
+    # would then report it as leaked or unlink it while the parent still owns it
+    for shm in shms:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    images = None
+    try:
+        images = [np.ndarray(page_buffer.shape, dtype=page_buffer.dtype, buffer=shm.buf)
+                  for page_buffer, shm in zip(page_buffers, shms)]
+        easyocr_results = run_easyocr_batch(images, [page_buffer.scale for page_buffer in page_buffers])
+        return [{'tesseract': run_tesseract(image, page_buffer.scale), 'easyocr': easyocr_boxes}
+                for image, page_buffer, easyocr_boxes in zip(images, page_buffers, easyocr_results)]
+    finally:
+        # Views must be dropped before the mappings can be closed
+        images = None
+        for shm in shms:
+            shm.close()
 
 def fast_ensemble_voting(ocr_results: Dict[str, List[BoundingBox]], iou_threshold: float = 0.25) -> List[BoundingBox]:
     """Combines results from multiple OCR engines for a single page."""
     all_boxes = [box for boxes in ocr_results.values() for box in boxes]
     if not all_boxes: return []
-    final_boxes, used_indices = [], set()
-    for i, box1 in enumerate(all_boxes):
-        if i in used_indices: continue
-        cluster = [box1]
-        used_indices.add(i)
-        for j, box2 in enumerate(all_boxes[i+1:], i+1):
-            if j not in used_indices and calculate_iou_fast(box1, box2) > iou_threshold:
-                cluster.append(box2)
-                used_indices.add(j)
-        final_boxes.append(max(cluster, key=lambda b: b.confidence))
-    return final_boxes
+    # Structure-of-arrays layout so the JIT kernel never touches Python objects
+    x1 = np.array([b.x1 for b in all_boxes], dtype=np.float32)
+    y1 = np.array([b.y1 for b in all_boxes], dtype=np.float32)
+    x2 = np.array([b.x2 for b in all_boxes], dtype=np.float32)
+    y2 = np.array([b.y2 for b in all_boxes], dtype=np.float32)
+    conf = np.array([b.confidence for b in all_boxes], dtype=np.float32)
+    area = np.array([b.area for b in all_boxes], dtype=np.float32)
+    keep = _nms(x1, y1, x2, y2, area, conf, iou_threshold)
+    return [all_boxes[i] for i in keep]
+
+def median_font_size(font_sizes) -> Optional[float]:
+    """Returns the upper median of the given font sizes, or None if there are none."""
+    sizes = np.fromiter(font_sizes, dtype=np.float64)
+    if not sizes.size: return None
+    mid = sizes.size // 2
+    return np.partition(sizes, mid)[mid]
 
 def create_document_outline(all_boxes_with_page: List[Tuple[int, BoundingBox]]) -> Dict[str, Any]:
     """Identifies the document title and headings to create a structured outline."""
@@ -149,80 +395,236 @@ def create_document_outline(all_boxes_with_page: List[Tuple[int, BoundingBox]])
     first_page_boxes = [box for page_idx, box in all_boxes_with_page if page_idx == 0]
     title_box = max(first_page_boxes, key=lambda b: b.font_size) if first_page_boxes else None
     document_title = title_box.text if title_box else ""
-    all_font_sizes = [box.font_size for _, box in all_boxes_with_page if len(box.text) > 2]
-    if not all_font_sizes: return {"title": document_title, "outline": []}
-    sorted_sizes = sorted(all_font_sizes)
-    median_size = sorted_sizes[len(sorted_sizes) // 2]
-    h1_threshold, h2_threshold = median_size * 1.6, median_size * 1.3
+    # OCR height estimates and native point sizes live on different scales, so each gets its own median
+    ocr_median = median_font_size(box.font_size for _, box in all_boxes_with_page if box.bold is None and box.n_chars > 2)
+    native_median = median_font_size(box.font_size for _, box in all_boxes_with_page if box.bold is not None and box.n_chars > 2)
+    if ocr_median is None and native_median is None: return {"title": document_title, "outline": []}
+    if ocr_median is not None:
+        h1_threshold, h2_threshold = ocr_median * 1.6, ocr_median * 1.3
     outline = []
-    sorted_boxes = sorted(all_boxes_with_page, key=lambda item: (item[0], item[1].y1))
+    # Order by (page, y1) via a key-array lexsort rather than a per-item Python key function
+    pages = np.fromiter((page_idx for page_idx, _ in all_boxes_with_page), dtype=np.int32)
+    y1s = np.fromiter((box.y1 for _, box in all_boxes_with_page), dtype=np.float64)
+    sorted_boxes = [all_boxes_with_page[i] for i in np.lexsort((y1s, pages))]
     for page_idx, box in sorted_boxes:
         if box is title_box: continue
-        text = box.text
-        if len(text) < 3 or len(text) > 120 or text.endswith('.') or text.count(' ') > 10: continue
-        level = "H1" if box.font_size >= h1_threshold else "H2" if box.font_size >= h2_threshold else None
+        if box.n_chars < 3 or box.n_chars > 120 or box.ends_dot or box.n_spaces > 10: continue
+        if box.bold is None:
+            level = "H1" if box.font_size >= h1_threshold else "H2" if box.font_size >= h2_threshold else None
+        elif not NATIVE_WORD_PATTERN.search(box.text):
+            level = None
+        else:
+            ratio = box.font_size / native_median
+            level = ("H1" if ratio >= NATIVE_H1_RATIO else
+                     "H2" if ratio >= NATIVE_H2_RATIO or (box.bold and ratio > 1.0) else None)
         if level:
-            outline.append({"level": level, "text": text, "page": page_idx})
+            outline.append({"level": level, "text": box.text, "page": page_idx})
     return {"title": document_title, "outline": outline}
 
 # --- Main Processing Function ---
 
-def process_single_pdf_fast(pdf_path: Path, output_dir: Path):
-    """Fully optimized PDF processing workflow."""
-    start_time = time.time()
-    logger.info(f"Processing {pdf_path.name} to generate document outline...")
+class PdfJob:
+    """Per-PDF state while its pages are being rendered and OCR'd on the shared pools."""
+    __slots__ = ['pdf_path', 'start_time', 'boxes_by_page', 'ocr_results_by_page', 'block_size',
+                 'unblocked_pages', 'rendering', 'renders_pending', 'pending', 'failed']
 
-    try:
-        page_bytes_list = extract_pdf_pages_fast(pdf_path)
-        if not page_bytes_list:
+    def __init__(self, pdf_path: Path, start_time: float, boxes_by_page: Dict[int, List[BoundingBox]],
+                 block_size: int):
+        self.pdf_path = pdf_path
+        self.start_time = start_time
+        self.boxes_by_page = boxes_by_page
+        self.ocr_results_by_page = {}
+        self.block_size = block_size
+        # Rendered pages not yet handed to an OCR block, grouped by render scale so that a block
+        # never mixes zooms and EasyOCR's padded batch doesn't blow small pages up to scan size
+        self.unblocked_pages = defaultdict(list)
+        self.rendering = True  # Renders are still being submitted
+        self.renders_pending = 0
+        self.pending = 0  # OCR blocks in flight
+        self.failed = False
+
+def finish_pdf(job: PdfJob, output_dir: Path):
+    """Merges a completed PDF's OCR results, builds its outline and writes the JSON output."""
+    for page_idx, ocr_results in job.ocr_results_by_page.items():
+        job.boxes_by_page[page_idx] = fast_ensemble_voting(ocr_results)
+    all_consensus_boxes_with_page_info = []
+    for page_idx in sorted(job.boxes_by_page.keys()):
+        for box in job.boxes_by_page[page_idx]:
+            all_consensus_boxes_with_page_info.append((page_idx, box))
+    
+    output_data = create_document_outline(all_consensus_boxes_with_page_info)
+    output_file = output_dir / f"{job.pdf_path.stem}.json"
+    output_file.write_bytes(orjson.dumps(output_data, option=orjson.OPT_INDENT_2))
+
+    processing_time = time.time() - job.start_time
+    logger.info(f"✅ Completed {job.pdf_path.name} in {processing_time:.2f}s. Outline has {len(output_data['outline'])} headings.")
+    logger.info(f"   Output saved to: {output_file}")
+
+class OcrPipeline:
+    """Streams the pages of many PDFs through the render and OCR pools.
+
+    At most MAX_PAGES_IN_FLIGHT pages are being rendered or held in shared memory at any time:
+    once the budget is used up, the next render waits for OCR blocks to finish, so a single
+    large PDF is bounded as well. Each PDF is written as soon as its own pages are done.
+    """
+    __slots__ = ['executor', 'render_executor', 'output_dir', 'render_futures', 'ocr_futures',
+                 'jobs', 'pages_in_flight', 'current_pdf']
+
+    def __init__(self, executor: ProcessPoolExecutor, render_executor: ProcessPoolExecutor, output_dir: Path):
+        self.executor = executor
+        self.render_executor = render_executor
+        self.output_dir = output_dir
+        self.render_futures = {}  # Future -> (job, page_idx)
+        self.ocr_futures = {}  # Future -> (job, block of (page_idx, PageBuffer))
+        self.jobs = set()  # Unfinished jobs that may still hold unblocked pages
+        self.pages_in_flight = 0
+        self.current_pdf = None
+
+    def submit_pdf(self, pdf_path: Path):
+        """Reads a PDF's text layer and streams its remaining pages through rendering and OCR."""
+        start_time = time.time()
+        self.current_pdf = pdf_path
+        logger.info(f"Processing {pdf_path.name} to generate document outline...")
+        page_records = extract_pdf_pages_fast(pdf_path)
+        if not page_records:
             logger.error(f"No pages extracted from {pdf_path}"); return
 
-        logger.info(f"Extracted {len(page_bytes_list)} pages. Initializing process pool...")
+        boxes_by_page = {page_idx: native_blocks_to_boxes(blocks)
+                         for kind, page_idx, blocks in page_records if kind == "native"}
+        image_pages = [(page_idx, zoom) for kind, page_idx, zoom in page_records if kind == "image"]
+        logger.info(f"Extracted {len(page_records)} pages ({len(boxes_by_page)} with a native text layer). "
+                    f"Submitting OCR tasks for {len(image_pages)} pages...")
+        # Each OCR task runs both engines on a block of attached pages, amortizing model invocation
+        # and IPC overhead; blocks stay small enough for every worker to hold one within the budget.
         num_cores = get_cpu_cores()
-        
-        all_consensus_boxes_with_page_info = []
-        
-        # Use the initializer to load models only once per worker process
-        with ProcessPoolExecutor(max_workers=num_cores, initializer=initialize_worker) as executor:
-            tasks = []
-            for page_idx, page_bytes in enumerate(page_bytes_list):
-                tasks.append(executor.submit(run_tesseract, page_bytes))
-                tasks.append(executor.submit(run_easyocr, page_bytes))
-
-            # This is complex to map back. Let's simplify and keep the page_idx.
-            # RETHINK: A better submission pattern is needed to track page index.
-            
-            # Let's use a simpler and more direct submission pattern.
-            futures = {}
-            for page_idx, page_bytes in enumerate(page_bytes_list):
-                # Submit both OCR tasks for the same page
-                futures[executor.submit(run_tesseract, page_bytes)] = (page_idx, 'tesseract')
-                futures[executor.submit(run_easyocr, page_bytes)] = (page_idx, 'easyocr')
-            
-            results_by_page = defaultdict(dict)
-            for future in as_completed(futures):
-                page_idx, ocr_name = futures[future]
-                boxes = future.result()
-                results_by_page[page_idx][ocr_name] = boxes
-
-        for page_idx in sorted(results_by_page.keys()):
-            consensus_boxes = fast_ensemble_voting(results_by_page[page_idx])
-            for box in consensus_boxes:
-                all_consensus_boxes_with_page_info.append((page_idx, box))
-        
-        output_data = create_document_outline(all_consensus_boxes_with_page_info)
-        output_file = output_dir / f"{pdf_path.stem}.json"
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(output_data, f, indent=4, ensure_ascii=False)
-
-        processing_time = time.time() - start_time
-        logger.info(f"✅ Completed {pdf_path.name} in {processing_time:.2f}s. Outline has {len(output_data['outline'])} headings.")
-        logger.info(f"   Output saved to: {output_file}")
+        block_size = max(1, min(len(image_pages) // num_cores, MAX_PAGES_IN_FLIGHT // (2 * num_cores)))
+        job = PdfJob(pdf_path, start_time, boxes_by_page, block_size)
+        self.jobs.add(job)
+        for page_idx, zoom in image_pages:
+            while self.pages_in_flight >= MAX_PAGES_IN_FLIGHT and self.collect(block=True): pass
+            if job.failed: break
+            future = self.render_executor.submit(render_page, pdf_path, page_idx, zoom)
+            self.render_futures[future] = (job, page_idx)
+            job.renders_pending += 1
+            self.pages_in_flight += 1
+            self.collect(block=False)
+        job.rendering = False
+        self._advance(job)
+
+    def collect(self, block: bool) -> bool:
+        """Handles every finished render and OCR task, first waiting for one if block is set.
+
+        Returns False once nothing is left in flight.
+        """
+        if not self.render_futures and not self.ocr_futures: return False
+        done, _ = wait([*self.render_futures, *self.ocr_futures], timeout=None if block else 0,
+                       return_when=FIRST_COMPLETED)
+        for future in done:
+            if future in self.render_futures:
+                self._collect_render(future)
+            else:
+                self._collect_block(future)
+        return True
+
+    def drain(self):
+        """Waits for every page in flight, writing each remaining PDF as it completes."""
+        while self.collect(block=True): pass
+
+    def release_all(self):
+        """Frees the shared memory of every page the pipeline still holds, e.g. after a failure."""
+        for future in self.render_futures:
+            # A render that was already running still creates a block that has to be unlinked
+            if not future.cancel() and future.exception() is None:
+                release_page_buffer(future.result())
+        for _, block in self.ocr_futures.values():
+            for _, page_buffer in block:
+                release_page_buffer(page_buffer)
+        for job in self.jobs:
+            for pages in job.unblocked_pages.values():
+                for _, page_buffer in pages:
+                    release_page_buffer(page_buffer)
+
+    def _collect_render(self, future: Future):
+        """Queues a rendered page for OCR, or drops its PDF if the page could not be rendered."""
+        job, page_idx = self.render_futures.pop(future)
+        job.renders_pending -= 1
+        self.current_pdf = job.pdf_path
+        try:
+            page_buffer = future.result()
+        except Exception as e:
+            self.pages_in_flight -= 1
+            # A dead render worker breaks the pool for every later PDF, so it must abort the run
+            # rather than be reported as a problem with this one document
+            if isinstance(e, BrokenProcessPool): raise
+            self._fail(job, e)
+            return
+        if job.failed:
+            release_page_buffer(page_buffer)
+            self.pages_in_flight -= 1
+            return
+        job.unblocked_pages[page_buffer.scale].append((page_idx, page_buffer))
+        self._advance(job)
+
+    def _collect_block(self, future: Future):
+        """Stores a finished block's OCR results and frees its pages."""
+        job, block = self.ocr_futures.pop(future)
+        self.current_pdf = job.pdf_path
+        try:
+            for (page_idx, _), ocr_results in zip(block, future.result()):
+                job.ocr_results_by_page[page_idx] = ocr_results
+        finally:
+            for _, page_buffer in block:
+                release_page_buffer(page_buffer)
+            self.pages_in_flight -= len(block)
+        job.pending -= 1
+        self._advance(job)
+
+    def _advance(self, job: PdfJob):
+        """Submits a job's full OCR blocks (and its partial ones once all pages are rendered) and
+        writes its output when nothing is left."""
+        if job.failed: return
+        rendered = not job.rendering and job.renders_pending == 0
+        for pages in job.unblocked_pages.values():
+            while len(pages) >= job.block_size or (rendered and pages):
+                block = pages[:job.block_size]
+                future = self.executor.submit(run_page_block, [page_buffer for _, page_buffer in block])
+                del pages[:job.block_size]
+                self.ocr_futures[future] = (job, block)
+                job.pending += 1
+        if rendered and job.pending == 0:
+            self.jobs.discard(job)
+            finish_pdf(job, self.output_dir)
+
+    def _fail(self, job: PdfJob, error: Exception):
+        """Drops a PDF whose pages cannot be rendered, freeing the pages it already holds."""
+        if not job.failed:
+            logger.error(f"Failed to extract pages from {job.pdf_path}: {error}")
+        job.failed = True
+        self.jobs.discard(job)
+        for pages in job.unblocked_pages.values():
+            for _, page_buffer in pages:
+                release_page_buffer(page_buffer)
+            self.pages_in_flight -= len(pages)
+        job.unblocked_pages.clear()
+
+def process_pdfs(pdf_files: List[Path], output_dir: Path, executor: ProcessPoolExecutor,
+                 render_executor: ProcessPoolExecutor):
+    """Streams every PDF through the shared pools so pages from different files interleave."""
+    pipeline = OcrPipeline(executor, render_executor, output_dir)
+    try:
+        for pdf_file in pdf_files:
+            pipeline.submit_pdf(pdf_file)
+        pipeline.drain()
 
     except Exception as e:
-        logger.error(f"❌ Failed to process {pdf_path}: {e}", exc_info=True)
+        logger.error(f"❌ Failed to process {pipeline.current_pdf}: {e}", exc_info=True)
+        # Drop queued work first, otherwise leaving the pools' `with` block waits for all of it
+        executor.shutdown(wait=False, cancel_futures=True)
+        render_executor.shutdown(wait=False, cancel_futures=True)
         # --- TESTING FIX: Exit with an error code on failure ---
         sys.exit(1)
+    finally:
+        pipeline.release_all()
 
 # --- Main Execution Block ---
 
@@ -236,10 +638,14 @@ def main():
     if not pdf_files:
         logger.warning("No PDF files found in /app/input"); return
 
-    logger.info(f"Processing {len(pdf_files)} PDFs with {get_cpu_cores()} CPU cores")
+    num_cores = get_cpu_cores()
+    logger.info(f"Processing {len(pdf_files)} PDFs with {num_cores} CPU cores")
     total_start = time.time()
-    for pdf_file in pdf_files:
-        process_single_pdf_fast(pdf_file, output_dir)
+    # One pool for the whole run so OCR models are loaded once per worker, not once per PDF,
+    # plus a lightweight model-free pool for page rasterization
+    with ProcessPoolExecutor(max_workers=num_cores, initializer=initialize_worker) as executor, \
+            ProcessPoolExecutor(max_workers=num_cores) as render_executor:
+        process_pdfs(pdf_files, output_dir, executor, render_executor)
     logger.info(f"Total processing time: {time.time() - total_start:.2f} seconds")
 
 if __name__ == "__main__":